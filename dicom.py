@@ -1,6 +1,616 @@
+import array
+import atexit
+import bisect
+import hashlib
+import io
 import math
+import mmap
+import os
+import Queue
 import struct
-from collections import defaultdict
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+
+
+""" Array view over the bytes of a numeric value, decoded on access. """
+class NumericValue(object):
+  __slots__ = ("data", "format", "itemsize", "big_endian")
+
+
+  """ The struct format of the items of each numeric VR. """
+  FORMATS = {
+    "AT": "H",  # Attribute Tag, as group and element pairs
+    "FD": "d",  # Floating Point Double
+    "FL": "f",  # Floating Point Single
+    "OD": "d",  # Other Double String
+    "OF": "f",  # Other Float String
+    "OL": "I",  # Other Long String
+    "OW": "H",  # Other Word String
+    "SL": "i",  # Signed Long
+    "SS": "h",  # Signed Short
+    "UL": "I",  # Unsigned Long
+    "US": "H"   # Unsigned Short
+  }
+
+
+  """ Constructor. """
+  def __init__(self, data, format, big_endian=False):
+    # The value bytes are referenced, not copied.
+    self.data = data
+    self.format = (">" if big_endian else "<") + format
+    self.itemsize = struct.calcsize(self.format)
+    self.big_endian = big_endian
+
+
+  def __len__(self):
+    return len(self.data) // self.itemsize
+
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      start, stop, step = i.indices(len(self))
+      if step != 1:
+        return self.tolist()[i]
+      size = max(stop - start, 0) * self.itemsize
+      return NumericValue(buffer(self.data, start * self.itemsize, size),
+                          self.format[1:], self.big_endian)
+    if i < 0:
+      i += len(self)
+    if i < 0 or i >= len(self):
+      raise IndexError(i)
+    return struct.unpack_from(self.format, self.data, i * self.itemsize)[0]
+
+
+  def __iter__(self):
+    return iter(self.toarray())
+
+
+  def __str__(self):
+    return "\\".join(str(v) for v in self.toarray())
+
+
+  """ Decode every item at once into an array. """
+  def toarray(self):
+    values = array.array(self.format[1:])
+    if values.itemsize != self.itemsize:
+      # The platform's array type has a different width, so go item by item.
+      return array.array(self.format[1:], self.tolist())
+    values.fromstring(buffer(self.data, 0, len(self) * self.itemsize))
+    if self.big_endian != (sys.byteorder == "big"):
+      values.byteswap()
+    return values
+
+
+  """ Decode every item into a list. """
+  def tolist(self):
+    n = len(self)
+    return list(struct.unpack(self.format[0] + self.format[1:] * n,
+                              buffer(self.data, 0, n * self.itemsize)))
+
+
+""" Decode a numeric value, or None if the VR is not numeric. """
+def decodeValue(vr, data, big_endian=False):
+  format = NumericValue.FORMATS.get(vr)
+  if format is None:
+    return None
+  return NumericValue(data, format, big_endian)
+
+
+
+""" Reader session which can be shared across many sequential File parses. """
+class Reader(object):
+  """ Constructor. """
+  def __init__(self, initial_size=4096, reuse=False):
+    # With reuse, values are views into a buffer which is grown on demand and
+    # reused for every value read, so a view is only valid until the next
+    # value is read and handlers must copy anything they keep. Without it
+    # values are plain strings.
+    self.reuse = reuse
+    self.buf = bytearray(initial_size if reuse else 0)
+    self.f = None
+
+
+  """ Open a file, closing the file previously opened by this reader. """
+  def open(self, filename):
+    self.close()
+    self.f = open(filename, "rb")
+    return self.f
+
+
+  """ Read a value, into the shared buffer when reusing it. """
+  def read(self, f, size):
+    if not self.reuse:
+      return f.read(size)
+    if size > len(self.buf):
+      self.buf = bytearray(max(size, len(self.buf) * 2))
+    n = f.readinto(memoryview(self.buf)[:size])
+    return buffer(self.buf, 0, n)
+
+
+  """ Close the currently open file, if any. """
+  def close(self):
+    if self.f is not None:
+      self.f.close()
+      self.f = None
+
+
+  def __enter__(self):
+    return self
+
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+
+""" Reader session which parses files from memory after prefetching them. """
+class PrefetchReader(Reader):
+  """ Constructor. """
+  def __init__(self, initial_size=4096, reuse=False):
+    super(PrefetchReader, self).__init__(initial_size, reuse)
+    self.data = {}
+
+
+  """ Read a whole file into memory with large aligned chunked reads. """
+  def prefetch(self, filename, chunk_size=1 << 20):
+    fin = io.open(filename, "rb", buffering=0)
+    try:
+      data = bytearray(os.fstat(fin.fileno()).st_size)
+      view = memoryview(data)
+      pos = 0
+      while pos < len(data):
+        n = fin.readinto(view[pos:pos + chunk_size])
+        if not n:
+          break
+        pos += n
+    finally:
+      fin.close()
+    self.data[filename] = data[:pos] if pos < len(data) else data
+
+
+  """ Open a prefetched file from memory, or any other file from disk. """
+  def open(self, filename):
+    if filename not in self.data:
+      return super(PrefetchReader, self).open(filename)
+    self.close()
+    self.f = io.BytesIO(self.data.pop(filename))
+    return self.f
+
+
+
+""" Descriptor of pixel data placed in a shared memory block. """
+PixelDescriptor = namedtuple("PixelDescriptor",
+                             ["name", "offset", "shape", "dtype"])
+
+
+""" Pool of shared memory blocks for handing pixel data to other processes. """
+class SharedPixelPool(object):
+  """ Constructor. """
+  def __init__(self, directory=None, max_blocks=32, max_bytes=512 << 20):
+    # Blocks are files in a memory backed directory which other processes can
+    # map by name. No descriptor is held open for them between puts.
+    if directory is None:
+      if os.path.isdir("/dev/shm"):
+        directory = "/dev/shm"
+      else:
+        directory = tempfile.gettempdir()
+    self.directory = directory
+    self.max_blocks = max_blocks
+    self.max_bytes = max_bytes
+    # Block name -> block size.
+    self.blocks = {}
+    self.free = []
+    self.condition = threading.Condition()
+    # Blocks left behind by a pool which is never closed are removed on exit.
+    atexit.register(self.close)
+
+
+  """ Copy pixel data into a shared block and return its descriptor. """
+  def put(self, data, shape, dtype, block=True, timeout=None):
+    # When the pool is full, wait for a block to be released unless told not
+    # to block, and raise if none is released in time.
+    name = self._acquire(len(data), block, timeout)
+    f = open(name, "r+b")
+    try:
+      f.write(data)
+    finally:
+      f.close()
+    return PixelDescriptor(name, 0, tuple(shape), dtype)
+
+
+  """ Return the block of a descriptor to the pool once consumers are done. """
+  def release(self, descriptor):
+    with self.condition:
+      if descriptor.name in self.blocks and descriptor.name not in self.free:
+        self.free.append(descriptor.name)
+        self.condition.notify_all()
+
+
+  """ Remove all of the blocks in the pool. """
+  def close(self):
+    with self.condition:
+      for name in self.blocks:
+        try:
+          os.unlink(name)
+        except OSError:
+          pass
+      self.blocks = {}
+      self.free = []
+      self.condition.notify_all()
+
+
+  def __enter__(self):
+    return self
+
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+  """ Helper to find the smallest free block which fits, or create one. """
+  def _acquire(self, size, block, timeout):
+    if self.max_bytes is not None and size > self.max_bytes:
+      raise Exception("Pixel data larger than the shared pixel pool:", size)
+    deadline = None if timeout is None else time.time() + timeout
+    with self.condition:
+      while True:
+        best = None
+        for name in self.free:
+          if self.blocks[name] >= size:
+            if best is None or self.blocks[name] < self.blocks[best]:
+              best = name
+        if best is not None:
+          self.free.remove(best)
+          return best
+
+        # Drop free blocks which are too small to make room for a new one.
+        while self.free and not self._fits(size):
+          name = self.free.pop()
+          os.unlink(name)
+          del self.blocks[name]
+        if self._fits(size):
+          fd, name = tempfile.mkstemp(prefix="dicom-", dir=self.directory)
+          try:
+            os.ftruncate(fd, max(size, 1))
+          finally:
+            os.close(fd)
+          self.blocks[name] = size
+          return name
+
+        wait = None if deadline is None else deadline - time.time()
+        if not block or (wait is not None and wait <= 0):
+          raise Exception("Shared pixel pool is full.")
+        self.condition.wait(wait)
+
+
+  """ Helper to check whether a new block fits within the pool limits. """
+  def _fits(self, size):
+    if self.max_blocks is not None and len(self.blocks) >= self.max_blocks:
+      return False
+    if (self.max_bytes is not None and
+        sum(self.blocks.values()) + size > self.max_bytes):
+      return False
+    return True
+
+
+""" Map the pixel data of a descriptor from any process. """
+def attachPixels(descriptor):
+  itemsize = int(descriptor.dtype[-1])
+  count = 1
+  for n in descriptor.shape:
+    count *= n
+  f = open(descriptor.name, "rb")
+  try:
+    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  finally:
+    f.close()
+  return buffer(m, descriptor.offset, count * itemsize)
+
+
+
+""" Cache of per series intensity statistics for windowing slices alike. """
+class SeriesStatistics(object):
+  """ Number of histogram bins, one per value of the 12 bits kept. """
+  BINS = 4096
+
+
+  """ Table for masking out the noisy high order bits of the high byte. """
+  HIGH_MASK = bytearray(i & 0x0f for i in range(256))
+
+
+  """ Constructor. """
+  def __init__(self):
+    # Series Instance UID -> [histogram, min, max, count]
+    self.series = {}
+
+
+  """ Decode 16 bit pixel data into an array of its low 12 bit values. """
+  @staticmethod
+  def values(data):
+    raw = bytearray(data)
+    raw[1::2] = raw[1::2].translate(SeriesStatistics.HIGH_MASK)
+    return decodeValue("OW", raw).toarray()
+
+
+  """ Accumulate a slice into the statistics of its series. """
+  def add(self, uid, values):
+    if not values:
+      return
+    ordered = sorted(values)
+    histogram = array.array("L", [0]) * SeriesStatistics.BINS
+    below = 0
+    for v in range(ordered[0], ordered[-1] + 1):
+      upto = bisect.bisect_right(ordered, v, below)
+      histogram[v] = upto - below
+      below = upto
+
+    stats = self.series.get(uid)
+    if stats is None:
+      self.series[uid] = [histogram, ordered[0], ordered[-1], len(ordered)]
+    else:
+      for v in range(ordered[0], ordered[-1] + 1):
+        stats[0][v] += histogram[v]
+      stats[1] = min(stats[1], ordered[0])
+      stats[2] = max(stats[2], ordered[-1])
+      stats[3] += len(ordered)
+
+
+  """ The value below which the given percent of a series' pixels fall. """
+  def percentile(self, uid, percent):
+    histogram, minVal, maxVal, count = self.series[uid]
+    target = count * percent / 100.0
+    total = 0
+    for v in range(minVal, maxVal + 1):
+      total += histogram[v]
+      if total >= target:
+        return v
+    return maxVal
+
+
+  """ The (low, high) window of a series, by default its full range. """
+  def window(self, uid, low=None, high=None):
+    stats = self.series[uid]
+    lowVal = stats[1] if low is None else self.percentile(uid, low)
+    highVal = stats[2] if high is None else self.percentile(uid, high)
+    return (lowVal, highVal)
+
+
+  def __contains__(self, uid):
+    return uid in self.series
+
+
+
+""" Helper to build the header of a 24 bit bitmap. """
+def _bitmapHeader(width, height):
+  mult4 = lambda n: int(math.ceil(n/4.0))*4
+  lh = lambda n: struct.pack("<h", n)
+  li = lambda n: struct.pack("<i", n)
+
+  return (b"BM" +
+          li((height * mult4(width * 3)) + 0x36) +
+          b"\x00\x00\x00\x00" + # Must be Zeros
+          b"\x36\x00\x00\x00" + # Offset of first pixel data
+          b"\x28\x00\x00\x00" + # Size of BitmapInfoHeader (40 bytes)
+          li(width) +           # Width
+          li(height) +          # Height
+          b"\x01\x00" +         # Color planes (always 1)
+          lh(24) +              # BPP
+          b"\x00\x00\x00\x00" + # No compression
+          b"\x00\x00\x00\x00" +
+          b"\x00\x00\x00\x00" +
+          b"\x00\x00\x00\x00" +
+          b"\x00\x00\x00\x00" +
+          b"\x00\x00\x00\x00")
+
+
+
+""" Writer of fixed size bitmap tiles for every level of an image pyramid. """
+class TilePyramid(object):
+  """ Constructor. """
+  def __init__(self, directory, width, height, tile_size=256):
+    self.directory = directory
+    self.tile_size = tile_size
+
+    # Level 0 is the full image and each further level halves it until the
+    # whole image fits in a single tile.
+    self.widths = [width]
+    self.heights = [height]
+    while max(self.widths[-1], self.heights[-1]) > tile_size:
+      self.widths.append((self.widths[-1] + 1) // 2)
+      self.heights.append((self.heights[-1] + 1) // 2)
+
+    # Per level, the gray rows not yet written and the rows seen so far.
+    self.pending = [[] for w in self.widths]
+    self.seen = [0 for w in self.widths]
+    self.tile_rows = [0 for w in self.widths]
+
+
+  """ Add the next rows of 8 bit gray pixels, from top to bottom. """
+  def addRows(self, rows, level=0):
+    if level >= len(self.widths):
+      return
+    # Every other row and column is kept for the next level down.
+    start = self.seen[level] % 2
+    self.seen[level] += len(rows)
+    self.addRows([row[::2] for row in rows[start::2]], level + 1)
+
+    pending = self.pending[level]
+    pending.extend(rows)
+    while len(pending) >= self.tile_size:
+      self._writeTileRow(level, pending[:self.tile_size])
+      del pending[:self.tile_size]
+
+
+  """ Write out the partial tiles left at the bottom of every level. """
+  def close(self):
+    for level, pending in enumerate(self.pending):
+      if pending:
+        self._writeTileRow(level, pending)
+      self.pending[level] = []
+
+
+  """ Helper to write one row of tiles of a level. """
+  def _writeTileRow(self, level, rows):
+    mult4 = lambda n: int(math.ceil(n/4.0))*4
+    directory = os.path.join(self.directory, str(level))
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    for col, x in enumerate(range(0, self.widths[level], self.tile_size)):
+      width = min(self.tile_size, self.widths[level] - x)
+      padding = b"\x00" * (mult4(width * 3) - (width * 3))
+      encoded = []
+      for row in reversed(rows):
+        gray = row[x:x + width]
+        pixels = bytearray(width * 3)
+        pixels[0::3] = gray
+        pixels[1::3] = gray
+        pixels[2::3] = gray
+        encoded.append(bytes(pixels))
+        encoded.append(padding)
+      name = "%d_%d.bmp" % (col, self.tile_rows[level])
+      fout = open(os.path.join(directory, name), "wb")
+      fout.write(_bitmapHeader(width, len(rows)))
+      fout.write(b"".join(encoded))
+      fout.close()
+    self.tile_rows[level] += 1
+
+
+
+""" Compact index of the offset and length of every element in a file. """
+class ElementIndex(object):
+  """ Sidecar header of magic, file size and file mtime. """
+  HEADER = struct.Struct("<4sQd")
+
+
+  """ Entry of group, element, VR, depth, value offset and value length. """
+  ENTRY = struct.Struct("<HH2sBII")
+
+
+  """ Magic number identifying index sidecars. """
+  MAGIC = b"DIDX"
+
+
+  """ Constructor. """
+  def __init__(self, size, mtime):
+    # The index is only valid for a file with the same size and mtime.
+    self.size = size
+    self.mtime = mtime
+    self.entries = bytearray()
+    # Top level tag -> position of its entry.
+    self.top = {}
+
+
+  """ Create an empty index for the current state of a file. """
+  @staticmethod
+  def forFile(filename):
+    st = os.stat(filename)
+    return ElementIndex(st.st_size, st.st_mtime)
+
+
+  """ The path of the index of a file, in a cache directory if given. """
+  @staticmethod
+  def path(filename, cache_directory=None):
+    if cache_directory is None:
+      return filename + ".idx"
+    key = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+    return os.path.join(cache_directory, key + ".idx")
+
+
+  """ Load the index of a file, or None if it is missing or out of date. """
+  @staticmethod
+  def load(filename, cache_directory=None):
+    try:
+      st = os.stat(filename)
+      fin = open(ElementIndex.path(filename, cache_directory), "rb")
+    except (IOError, OSError):
+      return None
+    try:
+      data = fin.read()
+    finally:
+      fin.close()
+    if len(data) < ElementIndex.HEADER.size:
+      return None
+    magic, size, mtime = ElementIndex.HEADER.unpack_from(data)
+    if (magic != ElementIndex.MAGIC or size != st.st_size or
+        mtime != st.st_mtime):
+      return None
+    index = ElementIndex(size, mtime)
+    entries = data[ElementIndex.HEADER.size:]
+    for pos in range(0, len(entries) - ElementIndex.ENTRY.size + 1,
+                     ElementIndex.ENTRY.size):
+      g, e, vr, depth, offset, length = ElementIndex.ENTRY.unpack_from(
+        entries, pos)
+      if depth == 0:
+        index.top.setdefault((g, e), pos)
+    index.entries = bytearray(entries)
+    return index
+
+
+  """ Parse a file once just to build and save its index. """
+  @staticmethod
+  def build(filename, cache_directory=None, reader=None):
+    index = ElementIndex.forFile(filename)
+    f = File(filename, reader)
+    f.index = index
+    try:
+      f.read()
+    finally:
+      f.close()
+    index.save(filename, cache_directory)
+    return index
+
+
+  """ Write the index out as a sidecar of the file. """
+  def save(self, filename, cache_directory=None):
+    if cache_directory is not None and not os.path.isdir(cache_directory):
+      os.makedirs(cache_directory)
+    fout = open(ElementIndex.path(filename, cache_directory), "wb")
+    fout.write(ElementIndex.HEADER.pack(ElementIndex.MAGIC, self.size,
+                                        self.mtime))
+    fout.write(self.entries)
+    fout.close()
+
+
+  """ Record an element. """
+  def add(self, tag, vr, depth, offset, length):
+    if depth == 0:
+      self.top.setdefault(tag, len(self.entries))
+    self.entries += ElementIndex.ENTRY.pack(tag[0], tag[1], vr,
+                                            min(depth, 0xff), offset, length)
+
+
+  """ The (tag, vr, depth, offset, length) of a top level element. """
+  def find(self, tag):
+    pos = self.top.get(tag)
+    if pos is None:
+      return None
+    return self._entry(pos)
+
+
+  """ Every (tag, vr, depth, offset, length) of a tag at any depth. """
+  def findAll(self, tag):
+    found = []
+    for pos in range(0, len(self.entries), ElementIndex.ENTRY.size):
+      entry = self._entry(pos)
+      if entry[0] == tag:
+        found.append(entry)
+    return found
+
+
+  def __len__(self):
+    return len(self.entries) // ElementIndex.ENTRY.size
+
+
+  """ Helper to unpack the entry at a position. """
+  def _entry(self, pos):
+    g, e, vr, depth, offset, length = ElementIndex.ENTRY.unpack_from(
+      buffer(self.entries), pos)
+    return ((g, e), vr, depth, offset, length)
 
 
 
@@ -446,17 +1056,36 @@ class File(object):
 
 
   """ Constructor. """
-  def __init__(self, filename):
-    self.f = open(filename, "rb")
-    pass
+  def __init__(self, filename, reader=None):
+    # Files parsed with a shared reader leave closing to the reader session.
+    self.owns_reader = reader is None
+    self.reader = reader if reader is not None else Reader()
+    self.f = self.reader.open(filename)
+    # When set, every element read is recorded in this ElementIndex.
+    self.index = None
+    # The stream the end of file is reported to, or None for no report.
+    self.out = sys.stdout
+
+
+  """ Close the underlying file handle. """
+  def close(self):
+    if self.owns_reader:
+      self.reader.close()
+
+
+  def __enter__(self):
+    return self
+
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
 
 
   """ Helper to read the DICOM file header. """
   def _readHeader(self):
     h = self.f.read(128)
-    for c in h:
-      if c != "\x00":
-        raise Exception("Invalid header: Not started with 128 zeroes.")
+    if h != "\x00" * 128:
+      raise Exception("Invalid header: Not started with 128 zeroes.")
     h = self.f.read(4)
     if h != "DICM":
       raise Exception("Invalid header: Not DICM:", h)
@@ -498,14 +1127,21 @@ class File(object):
 
   """ Helper to read a value from a data element. """
   def _readValue(self, tag, val, size, depth):
+    if self.index is not None:
+      self.index.add(tag, val, depth, self.f.tell(), size)
     if val == "SQ":
       self._handleSequenceStart(tag, val, size, depth)
       return ("", self._readFixedLengthSequence(size, depth))
     elif tag == (0xfffe, 0xe000):
       self._handleSequenceItem(tag, val, size, depth)
       return ("", self._readFixedLengthSequence(size, depth))
+    elif self._streamValue(tag, val, size, depth):
+      # A derived class consumed the value straight from the file.
+      return ("", size)
     else:
-      d = self.f.read(size)
+      # With a reusing reader the value is a view into the reader's buffer
+      # and is only valid until the next value is read.
+      d = self.reader.read(self.f, size)
       # Allow derived classes to handle this value.
       self._handleValue(tag, val, size, depth, d)
       return (d, size)
@@ -562,6 +1198,20 @@ class File(object):
     pass
 
 
+  """ Helper to let large values be read incrementally instead of whole. """
+  def _streamValue(self, tag, val, size, depth):
+    return False
+
+
+  """ Read a single top level value by seeking to it through an index. """
+  def readElement(self, tag, index):
+    entry = index.find(tag)
+    if entry is None:
+      return None
+    self.f.seek(entry[3])
+    return self.reader.read(self.f, entry[4])
+
+
   """ Read a Dicom file. """
   def read(self):
     self._readHeader()
@@ -588,27 +1238,34 @@ class File(object):
 
         self._readValue(t, v, l, 0)
     except EOFError:
-      print "EOF"
+      if self.out is not None:
+        print >>self.out, "EOF"
 
 
 
 """ Dicom Dump File """
 class DumpFile(File):
-  def __init__(self, filename):
-    super(self.__class__, self).__init__(filename)
+  """ The most values printed for a multi valued element. """
+  MAX_VALUES = 16
+
+
+  def __init__(self, filename, reader=None, out=None):
+    super(self.__class__, self).__init__(filename, reader)
+    # The stream the dump is written to.
+    self.out = out if out is not None else sys.stdout
     # The current tab spacing for debug output.
     self.current_tab = ""
 
 
   def _handleSequenceStart(self, tag, val, size, depth):
     super(self.__class__, self)._handleSequenceStart(tag, val, size, depth)
-    print self.current_tab + File.TAG_NAMES[tag]
+    print >>self.out, self.current_tab + File.TAG_NAMES[tag]
     self.current_tab += "  "
 
 
   def _handleSequenceItem(self, tag, val, size, depth):
     super(self.__class__, self)._handleSequenceItem(tag, val, size, depth)
-    print self.current_tab + "-----------------------"
+    print >>self.out, self.current_tab + "-----------------------"
     self.current_tab += "  "
 
 
@@ -619,32 +1276,30 @@ class DumpFile(File):
 
   def _handleValue(self, tag, val, size, depth, data):
     super(self.__class__, self)._handleValue(tag, val, size, depth, data)
-    print self.current_tab + File.TAG_NAMES[tag]
+    out = self.out
+    print >>out, self.current_tab + File.TAG_NAMES[tag]
     if len(data) == 0:
-      print self.current_tab + "  " + "Empty"
-    elif val == "US":
-      print self.current_tab + "  " + str(struct.unpack("H", data)[0])
-    elif val == "UL":
-      print self.current_tab + "  " + str(struct.unpack("I", data)[0])
-    elif val == "SS":
-      print self.current_tab + "  " + str(struct.unpack("h", data)[0])
+      print >>out, self.current_tab + "  " + "Empty"
+    elif val in NumericValue.FORMATS:
+      values = decodeValue(val, data)
+      if len(values) > DumpFile.MAX_VALUES:
+        print >>out, self.current_tab + "  " + str(
+          values[:DumpFile.MAX_VALUES]) + "\\...", "(values:", len(values), ")"
+      else:
+        print >>out, self.current_tab + "  " + str(values)
     elif val == "OB":
-      print self.current_tab + "  " + "(data size:", size, ")"
-    elif val == "OW":
-      print self.current_tab + "  " + "(data size:", size, ")"
+      print >>out, self.current_tab + "  " + "(data size:", size, ")"
     elif val == "UN":
-      print self.current_tab + "  " + "(data size:", size, ")"
-    elif val == "FD":
-      print self.current_tab + "  " + "(data size:", size, ")"
+      print >>out, self.current_tab + "  " + "(data size:", size, ")"
     elif val == "DA":
-      print self.current_tab + "  " + str(data[0:4] + "/" + data[4:6] +
-                                          "/" + data[6:])
+      print >>out, self.current_tab + "  " + str(data[0:4] + "/" + data[4:6] +
+                                               "/" + data[6:])
     elif val == "TM":
-      print self.current_tab + "  " + str(data[0:2] + ":" + data[2:4] +
-                                          ":" + data[4:])
+      print >>out, self.current_tab + "  " + str(data[0:2] + ":" + data[2:4] +
+                                               ":" + data[4:])
     elif val in ["UI", "SH", "AE", "CS", "PN", "LO", "IS", "DS", "ST", "AS",
                  "LT"]:
-      print self.current_tab + "  " + str(data)
+      print >>out, self.current_tab + "  " + str(data)
     else:
       raise Exception("Unhandled Value: ", val)
 
@@ -652,8 +1307,13 @@ class DumpFile(File):
 
 """ Dicom Image File """
 class ImageFile(File):
-  def __init__(self, filename, out_filename):
-    super(self.__class__, self).__init__(filename)
+  def __init__(self, filename, out_filename, reader=None, pixel_pool=None,
+               statistics=None, tile_directory=None, tile_size=256):
+    if tile_directory is not None and (out_filename is not None or
+                                       pixel_pool is not None):
+      raise Exception("Tiled export can not be combined with a bitmap or "
+                      "pixel pool output.")
+    super(self.__class__, self).__init__(filename, reader)
 
     # The most recent bitmap metadata read from the file.
     self.last_image_data = {
@@ -661,10 +1321,30 @@ class ImageFile(File):
       "height": 1024,
       "format": "",
       "samples": 1,
-      "bpp": 16
+      "bpp": 16,
+      "series": ""
     }
     self.out_filename = out_filename
 
+    # When a pool is given the pixel data is also shared with other processes
+    # through the descriptor of the most recent image.
+    self.pixel_pool = pixel_pool
+    self.last_pixel_descriptor = None
+
+    # When statistics are given every slice of a series shares one window.
+    # Windows come from a separate first pass: reading each slice of the
+    # series with no out_filename scans it into the statistics, and rendering
+    # a slice of a series which was never scanned is an error.
+    self.statistics = statistics
+
+    # When a tile directory is given the pixel data is streamed a band of
+    # rows at a time into a tiled pyramid instead of being read whole. It then
+    # never reaches _handleValue, so it can not be combined with a bitmap or
+    # a pixel pool, and with statistics it only renders from the window of a
+    # series scanned in an earlier pass without a tile directory.
+    self.tile_directory = tile_directory
+    self.tile_size = tile_size
+
 
   def _handleValue(self, tag, val, size, depth, data):
     super(self.__class__, self)._handleValue(tag, val, size, depth, data)
@@ -672,38 +1352,149 @@ class ImageFile(File):
     # Handle collecting File IDs
     if depth == 0:
       if tag == (0x0028, 0x0002):  # Samples Per Pixel
-        self.last_image_data["samples"] = struct.unpack("H", data)[0]
+        self.last_image_data["samples"] = decodeValue("US", data)[0]
       elif tag == (0x0028, 0x0004): # Photometric Interpretation
         self.last_image_data["format"] = str(data)
       elif tag == (0x0028, 0x0010): # Rows
-        self.last_image_data["height"] = struct.unpack("H", data)[0]
+        self.last_image_data["height"] = decodeValue("US", data)[0]
       elif tag == (0x0028, 0x0011): # Columns
-        self.last_image_data["width"] = struct.unpack("H", data)[0]
+        self.last_image_data["width"] = decodeValue("US", data)[0]
       elif tag == (0x0028, 0x0101): # Bits Stored
-        self.last_image_data["bpp"] = struct.unpack("H", data)[0]
+        self.last_image_data["bpp"] = decodeValue("US", data)[0]
+      elif tag == (0x0020, 0x000e): # Series Instance UID
+        self.last_image_data["series"] = str(data)
       elif tag == (0x7fe0, 0x0010): # Pixel Data
-        invert = False
-        if self.last_image_data["format"] == "MONOCHROME1 ":
-          invert = True
-        elif self.last_image_data["format"] == "MONOCHROME2 ":
-          invert = False
-        else:
-          raise Exception("Unsupported image format:",
-                          self.last_image_data["format"])
-        if self.last_image_data["bpp"] == 16:
-          self._slowWriteBitmap(self.last_image_data["width"],
-                                self.last_image_data["height"],
-                                self.last_image_data["samples"],
-                                self.last_image_data["bpp"],
-                                invert,
-                                data)
-        else:
-          self._writeBitmap(self.last_image_data["width"],
+        if self.pixel_pool is not None:
+          self._sharePixels(data)
+        if self.out_filename is not None:
+          self._renderPixels(data)
+        elif self.statistics is not None:
+          # Without output the slice is only scanned into its series window.
+          self.statistics.add(self.last_image_data["series"],
+                              SeriesStatistics.values(data))
+
+
+  def _streamValue(self, tag, val, size, depth):
+    if (depth != 0 or tag != (0x7fe0, 0x0010) or
+        self.tile_directory is None):
+      return False
+
+    width = self.last_image_data["width"]
+    height = self.last_image_data["height"]
+    bpp = self.last_image_data["bpp"]
+    table = self._grayTable(bpp, self._invert())
+    pyramid = TilePyramid(self.tile_directory, width, height, self.tile_size)
+    # Never read past the end of the value, into the next element.
+    remaining = size
+    for y in range(0, height, self.tile_size):
+      rows = min(self.tile_size, height - y)
+      wanted = rows * width * 2
+      band = self.reader.read(self.f, min(wanted, remaining))
+      remaining -= len(band)
+      if len(band) < wanted:
+        raise Exception("Pixel Data too short for the image:", size,
+                        width, height)
+      if bpp == 16:
+        # HACK: Exclude the high order bits which are noisy in the CT images.
+        values = SeriesStatistics.values(band)
+      else:
+        values = decodeValue("OW", band).toarray()
+      gray = b"".join(map(table.__getitem__, values))
+      pyramid.addRows([gray[r*width:(r+1)*width] for r in range(rows)])
+    pyramid.close()
+    if remaining > 0:
+      self.f.seek(remaining, 1)
+    return True
+
+
+  """ Helper to map each stored pixel value to an 8 bit gray byte. """
+  def _grayTable(self, bpp, invert):
+    if bpp == 16:
+      window = (0, SeriesStatistics.BINS - 1)
+      if self.statistics is not None:
+        window = self._seriesWindow()
+      return [chr(p) for p in self._windowTable(window, invert)]
+    shift = bpp - 8
+    table = []
+    for v in range(0x10000):
+      pixel = (v >> shift) & 0xff
+      if invert:
+        pixel = 0xff - pixel
+      table.append(chr(pixel))
+    return table
+
+
+  """ Helper to map each 12 bit value to an 8 bit pixel through a window. """
+  def _windowTable(self, window, invert):
+    minVal, maxVal = window
+    scale = float(max(maxVal - minVal, 1))
+    table = []
+    for v in range(SeriesStatistics.BINS):
+      clipped = min(max(v, minVal), maxVal)
+      pixel = int(float(clipped-minVal) / scale * float(255)) & 0xff
+      # HACK: Any noise should get turned black.
+      if pixel >= 235:
+        pixel = 0
+      if invert:
+        pixel = 0xff - pixel
+      table.append(pixel)
+    return table
+
+
+  """ Helper to get the cached window of the series being read. """
+  def _seriesWindow(self):
+    uid = self.last_image_data["series"]
+    if uid not in self.statistics:
+      raise Exception("Series not scanned into the statistics:", uid)
+    return self.statistics.window(uid)
+
+
+  """ Helper to check whether the image format is inverted. """
+  def _invert(self):
+    if self.last_image_data["format"] == "MONOCHROME1 ":
+      return True
+    elif self.last_image_data["format"] == "MONOCHROME2 ":
+      return False
+    else:
+      raise Exception("Unsupported image format:",
+                      self.last_image_data["format"])
+
+
+  """ Helper to place the pixel data into the shared pixel pool. """
+  def _sharePixels(self, data):
+    width = self.last_image_data["width"]
+    height = self.last_image_data["height"]
+    samples = self.last_image_data["samples"]
+    itemsize = len(data) // max(width * height * samples, 1)
+    if itemsize > 1:
+      dtype = "<u%d" % itemsize
+    else:
+      dtype = "u1"
+    self.last_pixel_descriptor = self.pixel_pool.put(
+      data, (height, width, samples), dtype)
+
+
+  """ Helper to render the pixel data into the output bitmap. """
+  def _renderPixels(self, data):
+    invert = self._invert()
+    if self.last_image_data["bpp"] == 16:
+      window = None
+      if self.statistics is not None:
+        window = self._seriesWindow()
+      self._slowWriteBitmap(self.last_image_data["width"],
                             self.last_image_data["height"],
                             self.last_image_data["samples"],
                             self.last_image_data["bpp"],
                             invert,
-                            data)
+                            data,
+                            window)
+    else:
+      self._writeBitmap(self.last_image_data["width"],
+                        self.last_image_data["height"],
+                        self.last_image_data["samples"],
+                        self.last_image_data["bpp"],
+                        invert,
+                        data)
 
 
   """ Helper to write out a bitmap. """
@@ -711,24 +1502,7 @@ class ImageFile(File):
     shift = bpp - 8
  
     mult4 = lambda n: int(math.ceil(n/4.0))*4
-    lh = lambda n: struct.pack("<h", n)
-    li = lambda n: struct.pack("<i", n)
-
-    header = (b"BM" +
-              li((height * mult4(width * 3)) + 0x36) +
-              b"\x00\x00\x00\x00" + # Must be Zeros
-              b"\x36\x00\x00\x00" + # Offset of first pixel data
-              b"\x28\x00\x00\x00" + # Size of BitmapInfoHeader (40 bytes)
-              li(width) +           # Width
-              li(height) +          # Height
-              b"\x01\x00" +         # Color planes (always 1)
-              lh(24) +              # BPP
-              b"\x00\x00\x00\x00" + # No compression
-              b"\x00\x00\x00\x00" +
-              b"\x00\x00\x00\x00" +
-              b"\x00\x00\x00\x00" +
-              b"\x00\x00\x00\x00" +
-              b"\x00\x00\x00\x00")
+    header = _bitmapHeader(width, height)
 
     extra_bytes = (mult4(width * 3) - (width * 3))
     encoded_data = b""
@@ -747,67 +1521,38 @@ class ImageFile(File):
     fout.close()
 
 
-  """ Helper to write out a bitmap. """
-  def _slowWriteBitmap(self, width, height, samples, bpp, invert, data):
-    maxVal = 0x0000
-    minVal = 0xffff
-    for r in range(height-1, -1, -1):
-      for c in range(width):
-        pixel = struct.unpack_from("<H", data, (r*width+c)*2)[0]
-        # HACK: Exclude the high order bits which are noisy in the CT images.
-        pixel = pixel & 0x0fff
-        if pixel > maxVal:
-          maxVal = pixel
-        if pixel < minVal:
-          minVal = pixel
+  """ Helper to write out a windowed bitmap in a single pass. """
+  def _slowWriteBitmap(self, width, height, samples, bpp, invert, data,
+                       window=None):
+    # HACK: Exclude the high order bits which are noisy in the CT images.
+    values = SeriesStatistics.values(data)
+    if window is None:
+      window = (min(values), max(values))
+
+    # Map every possible value to its output pixel once.
+    lut = [struct.pack("3B", p, p, p)
+           for p in self._windowTable(window, invert)]
  
     mult4 = lambda n: int(math.ceil(n/4.0))*4
-    lh = lambda n: struct.pack("<h", n)
-    li = lambda n: struct.pack("<i", n)
-
-    header = (b"BM" +
-              li((height * mult4(width * 3)) + 0x36) +
-              b"\x00\x00\x00\x00" + # Must be Zeros
-              b"\x36\x00\x00\x00" + # Offset of first pixel data
-              b"\x28\x00\x00\x00" + # Size of BitmapInfoHeader (40 bytes)
-              li(width) +           # Width
-              li(height) +          # Height
-              b"\x01\x00" +         # Color planes (always 1)
-              lh(24) +              # BPP
-              b"\x00\x00\x00\x00" + # No compression
-              b"\x00\x00\x00\x00" +
-              b"\x00\x00\x00\x00" +
-              b"\x00\x00\x00\x00" +
-              b"\x00\x00\x00\x00" +
-              b"\x00\x00\x00\x00")
+    header = _bitmapHeader(width, height)
 
-    extra_bytes = (mult4(width * 3) - (width * 3))
-    encoded_data = b""
+    padding = b"\x00" * (mult4(width * 3) - (width * 3))
+    rows = []
     for r in range(height-1, -1, -1):
-      for c in range(width):
-        pixel = struct.unpack_from("<H", data, (r*width+c)*2)[0]
-        # HACK: Exclude the high order bits which are noisy in the CT images.
-        pixel = pixel & 0x0fff
-        pixel = int(float(pixel-minVal) / float(maxVal-minVal) * float(255)) & 0xff
-        # HACK: Any noise should get turned black.
-        if pixel >= 235:
-          pixel = 0
-        if invert:
-          pixel = 0xff - pixel
-        encoded_data += struct.pack("3B", pixel, pixel, pixel)
-      for e in range(extra_bytes):
-        encoded_data += b"\x00"
+      rows.append(b"".join(map(lut.__getitem__,
+                               values[r*width:(r+1)*width])))
+      rows.append(padding)
     fout = open(self.out_filename, "wb")
-    fout.write(header);
-    fout.write(encoded_data)
+    fout.write(header)
+    fout.write(b"".join(rows))
     fout.close()
 
 
 
 """ Dicom Directory File """
 class DirectoryFile(File):
-  def __init__(self, filename):
-    super(self.__class__, self).__init__(filename)
+  def __init__(self, filename, reader=None):
+    super(self.__class__, self).__init__(filename, reader)
 
     # The most recent bitmap metadata read from the file.
     self.last_name = None
@@ -839,6 +1584,288 @@ class DirectoryFile(File):
     elif tag == (0x0008, 0x0008): # Image Type
       self.last_type = str(data)
     elif tag == (0x0028, 0x0010): # Rows
-      self.last_height = struct.unpack("H", data)[0]
+      self.last_height = decodeValue("US", data)[0]
     elif tag == (0x0028, 0x0011): # Columns
-      self.last_width = struct.unpack("H", data)[0]
+      self.last_width = decodeValue("US", data)[0]
+
+
+
+""" Dicom File from which a set of top level tags are extracted """
+class TagFile(File):
+  def __init__(self, filename, tags, reader=None):
+    super(self.__class__, self).__init__(filename, reader)
+
+    # The tags to extract and the raw values extracted so far.
+    self.tags = set(tags)
+    self.values = {}
+
+
+  def _handleValue(self, tag, val, size, depth, data):
+    super(self.__class__, self)._handleValue(tag, val, size, depth, data)
+    if depth == 0 and tag in self.tags:
+      self.values[tag] = str(data)
+
+
+
+""" Compact in memory dataset of parsed elements, decoded on access """
+class Dataset(object):
+  __slots__ = ("tags", "vrs", "spans", "buffer", "children", "filename")
+
+
+  """ Flag on a span length for values left in the file instead of memory. """
+  EXTERNAL = 0x80000000
+
+
+  """ VRs holding text, which is returned without its padding. """
+  TEXT_VRS = frozenset(["AE", "AS", "CS", "DA", "DS", "DT", "IS", "LO", "LT",
+                        "PN", "SH", "ST", "TM", "UI", "UT"])
+
+
+  """ Numeric VRs which are always returned as arrays. """
+  ARRAY_VRS = frozenset(["AT", "OD", "OF", "OL", "OW"])
+
+
+  """ Constructor. """
+  def __init__(self, filename=None):
+    # Parallel arrays of packed (group << 16 | element) tags, VRs packed into
+    # 16 bits and (offset, length) value spans into the shared buffer.
+    self.tags = array.array("I")
+    self.vrs = array.array("H")
+    self.spans = array.array("I")
+    self.buffer = b""
+    # Element position -> item datasets, for sequences only.
+    self.children = None
+    self.filename = filename
+
+
+  """ Record an element. """
+  def add(self, tag, vr, offset, length):
+    self.tags.append((tag[0] << 16) | tag[1])
+    self.vrs.append(struct.unpack("<H", vr)[0])
+    self.spans.append(offset)
+    self.spans.append(length)
+    return len(self.tags) - 1
+
+
+  def __len__(self):
+    return len(self.tags)
+
+
+  def __contains__(self, tag):
+    return self._position(tag) is not None
+
+
+  def __iter__(self):
+    for t in self.tags:
+      yield (int(t >> 16), int(t & 0xffff))
+
+
+  def __getitem__(self, tag):
+    i = self._position(tag)
+    if i is None:
+      raise KeyError(tag)
+    return self._decode(i)
+
+
+  """ The decoded value of a tag, or the default if it is missing. """
+  def get(self, tag, default=None):
+    i = self._position(tag)
+    if i is None:
+      return default
+    return self._decode(i)
+
+
+  """ The VR of a tag. """
+  def vr(self, tag):
+    i = self._position(tag)
+    if i is None:
+      raise KeyError(tag)
+    return struct.pack("<H", self.vrs[i])
+
+
+  """ The undecoded value bytes of a tag. """
+  def raw(self, tag):
+    i = self._position(tag)
+    if i is None:
+      raise KeyError(tag)
+    return self._raw(i)
+
+
+  """ The item datasets of a sequence tag. """
+  def sequence(self, tag):
+    i = self._position(tag)
+    if i is None or self.children is None or i not in self.children:
+      raise KeyError(tag)
+    return self.children[i]
+
+
+  """ Helper to find the position of a tag. """
+  def _position(self, tag):
+    try:
+      return self.tags.index((tag[0] << 16) | tag[1])
+    except ValueError:
+      return None
+
+
+  """ Helper to get the value bytes at a position. """
+  def _raw(self, i):
+    offset = self.spans[2*i]
+    length = self.spans[2*i + 1]
+    if length & Dataset.EXTERNAL:
+      fin = open(self.filename, "rb")
+      try:
+        fin.seek(offset)
+        return fin.read(length & ~Dataset.EXTERNAL)
+      finally:
+        fin.close()
+    return buffer(self.buffer, offset, length)
+
+
+  """ Helper to decode the value at a position. """
+  def _decode(self, i):
+    if self.children is not None and i in self.children:
+      return self.children[i]
+    vr = struct.pack("<H", self.vrs[i])
+    data = self._raw(i)
+    if vr in Dataset.TEXT_VRS:
+      return str(data).rstrip("\x00 ")
+    values = decodeValue(vr, data)
+    if values is None:
+      return str(data)
+    elif len(values) == 1 and vr not in Dataset.ARRAY_VRS:
+      return values[0]
+    return values
+
+
+
+""" Dicom File parsed into a compact Dataset """
+class DatasetFile(File):
+  def __init__(self, filename, reader=None, inline_limit=1024):
+    super(self.__class__, self).__init__(filename, reader)
+
+    # Values larger than the limit are left in the file and read on access.
+    self.inline_limit = inline_limit
+    self.dataset = Dataset(filename)
+    self.values = bytearray()
+    # Datasets and item lists enclosing the element being read.
+    self.stack = [self.dataset]
+
+
+  def _handleSequenceStart(self, tag, val, size, depth):
+    super(self.__class__, self)._handleSequenceStart(tag, val, size, depth)
+    dataset = self.stack[-1]
+    i = dataset.add(tag, val, 0, 0)
+    if dataset.children is None:
+      dataset.children = {}
+    dataset.children[i] = []
+    self.stack.append(dataset.children[i])
+
+
+  def _handleSequenceItem(self, tag, val, size, depth):
+    super(self.__class__, self)._handleSequenceItem(tag, val, size, depth)
+    item = Dataset(self.dataset.filename)
+    self.stack[-1].append(item)
+    self.stack.append(item)
+
+
+  def _handleSequenceOrItemEnd(self, size, depth):
+    super(self.__class__, self)._handleSequenceOrItemEnd(size, depth)
+    self.stack.pop()
+
+
+  def _streamValue(self, tag, val, size, depth):
+    if size <= self.inline_limit:
+      return False
+    self.stack[-1].add(tag, val, self.f.tell(), size | Dataset.EXTERNAL)
+    self.f.seek(size, 1)
+    return True
+
+
+  def _handleValue(self, tag, val, size, depth, data):
+    super(self.__class__, self)._handleValue(tag, val, size, depth, data)
+    self.stack[-1].add(tag, val, len(self.values), len(data))
+    self.values += data
+
+
+  """ Read the file and return its dataset. """
+  def read(self):
+    super(self.__class__, self).read()
+    # Every dataset of the file shares the one value buffer.
+    values = bytes(self.values)
+    datasets = [self.dataset]
+    while datasets:
+      dataset = datasets.pop()
+      dataset.buffer = values
+      if dataset.children is not None:
+        for items in dataset.children.values():
+          datasets.extend(items)
+    self.values = bytearray()
+    return self.dataset
+
+
+
+""" Batch reader which keeps many files in flight for high latency storage. """
+class BatchReader(object):
+  """ Constructor. """
+  def __init__(self, concurrency=8, chunk_size=1 << 20):
+    self.concurrency = concurrency
+    self.chunk_size = chunk_size
+
+
+  """ Parse many files, returning (filename, result, error) in order. """
+  def map(self, parse, filenames):
+    # Each worker prefetches a whole file, which releases the interpreter
+    # lock while waiting on storage, and then parses it from memory.
+    filenames = list(filenames)
+    results = [None] * len(filenames)
+    work = Queue.Queue()
+    for i, filename in enumerate(filenames):
+      work.put((i, filename))
+
+    def worker():
+      with PrefetchReader() as reader:
+        while True:
+          try:
+            i, filename = work.get_nowait()
+          except Queue.Empty:
+            return
+          try:
+            reader.prefetch(filename, self.chunk_size)
+            results[i] = (filename, parse(filename, reader), None)
+          except Exception as e:
+            reader.data.pop(filename, None)
+            results[i] = (filename, None, e)
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(self.concurrency, len(filenames)))]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    return results
+
+
+
+""" Batch parse returning the image files listed by a DICOMDIR. """
+def parseDirectory(filename, reader):
+  d = DirectoryFile(filename, reader)
+  d.out = None
+  d.read()
+  return d.files
+
+
+""" Batch parse returning the text dump of a file. """
+def parseDump(filename, reader):
+  out = io.BytesIO()
+  DumpFile(filename, reader, out).read()
+  return out.getvalue()
+
+
+""" Batch parse extracting the raw values of the given top level tags. """
+def parseTags(tags):
+  def parse(filename, reader):
+    t = TagFile(filename, tags, reader)
+    t.out = None
+    t.read()
+    return t.values
+  return parse
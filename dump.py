@@ -8,16 +8,18 @@ d.read()
 
 # Reading the directory will store all the image filenames in d.files.
 # Iterate over all those files to extract the images themselves.
+# A single reader session reuses its value buffer across all the files.
 image_filenames = [".\\medical\\" + f.strip() for f in d.files]
 count = 1
-for filename in image_filenames:
-  print filename
-  out_filename = ".\\images\\output" + str(count) + ".bmp"
-  print out_filename
-  sys.stdout.flush()
-  img = dicom.ImageFile(filename, out_filename)
-  img.read()
-  count = count + 1
+with dicom.Reader(reuse=True) as reader:
+  for filename in image_filenames:
+    print filename
+    out_filename = ".\\images\\output" + str(count) + ".bmp"
+    print out_filename
+    sys.stdout.flush()
+    img = dicom.ImageFile(filename, out_filename, reader)
+    img.read()
+    count = count + 1
 
 # Example of single file debugging for DICOM image files.
 #d = dicom.ImageFile(".\\medical\\DICOM\\8428\\8429\\84212", "test2.bmp")
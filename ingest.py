@@ -0,0 +1,234 @@
+import os
+import Queue
+import sys
+import threading
+import time
+from collections import deque
+
+import dicom
+
+
+
+""" Counters describing the throughput of an ingest service. """
+class IngestCounters(object):
+  """ Constructor. """
+  def __init__(self, max_failures=100):
+    self.lock = threading.Lock()
+    self.started = time.time()
+    self.queued = 0
+    self.processed = 0
+    self.failed = 0
+    self.deferred = 0
+    self.total_latency = 0.0
+    self.max_latency = 0.0
+    # (time, path, error) of the most recent failures.
+    self.failures = deque(maxlen=max_failures)
+
+
+  """ Record a file which finished processing, with its error if it failed. """
+  def finished(self, path, latency, error=None):
+    with self.lock:
+      if error is None:
+        self.processed += 1
+      else:
+        self.failed += 1
+        self.failures.append((time.time(), path, repr(error)))
+      self.total_latency += latency
+      self.max_latency = max(self.max_latency, latency)
+
+
+  """ A consistent copy of the counters. """
+  def snapshot(self, queue_depth):
+    with self.lock:
+      done = self.processed + self.failed
+      elapsed = max(time.time() - self.started, 1e-6)
+      return {
+        "queue_depth": queue_depth,
+        "queued": self.queued,
+        "processed": self.processed,
+        "failed": self.failed,
+        "deferred": self.deferred,
+        "mean_latency": self.total_latency / done if done else 0.0,
+        "max_latency": self.max_latency,
+        "throughput": done / elapsed,
+        "recent_failures": list(self.failures)
+      }
+
+
+
+""" Long running service which processes files dropped into a directory. """
+class IngestService(object):
+  """ Constructor. """
+  def __init__(self, directory, handler, workers=4, queue_size=64,
+               poll_interval=1.0, settle_polls=1, on_error=None):
+    # The handler is called as handler(path, reader) from a worker thread,
+    # and on_error, if given, as on_error(path, error) when the handler fails.
+    self.directory = directory
+    self.handler = handler
+    self.on_error = on_error
+    self.workers = workers
+    self.poll_interval = poll_interval
+    self.settle_polls = settle_polls
+    self.queue = Queue.Queue(queue_size)
+    self.counters = IngestCounters()
+
+    # Directory -> mtime, so that only changed directories are listed again.
+    self.directories = {}
+    # Path -> [size, mtime, stable polls, first seen] of incomplete files.
+    self.pending = {}
+    # Directory -> names of the files in it which have already been queued.
+    # Files rewritten in place under the same name are not ingested again.
+    self.done = {}
+
+    self.stopping = threading.Event()
+    self.threads = []
+
+
+  """ Start the poller and the worker pool. """
+  def start(self):
+    self.stopping.clear()
+    for i in range(self.workers):
+      self.threads.append(threading.Thread(target=self._work))
+    self.threads.append(threading.Thread(target=self._poll))
+    for t in self.threads:
+      t.daemon = True
+      t.start()
+
+
+  """ Stop polling and wait for the queued files to be processed. """
+  def stop(self):
+    self.stopping.set()
+    for t in self.threads:
+      t.join()
+    self.threads = []
+
+
+  """ A snapshot of the queue depth, latency and throughput counters. """
+  def stats(self):
+    return self.counters.snapshot(self.queue.qsize())
+
+
+  """ Scan the changed parts of the tree once and queue completed files. """
+  def poll(self):
+    found = self._scan()
+    for path in sorted(self.pending):
+      if path in found:
+        # A file is only stable once it is unchanged on a later poll.
+        continue
+      entry = self.pending[path]
+      try:
+        st = os.stat(path)
+      except OSError:
+        del self.pending[path]
+        continue
+      if (st.st_size, st.st_mtime) != (entry[0], entry[1]):
+        # Still being written.
+        entry[0:3] = [st.st_size, st.st_mtime, 0]
+        continue
+      entry[2] += 1
+      if entry[2] < self.settle_polls:
+        continue
+      try:
+        self.queue.put_nowait((path, entry[3]))
+      except Queue.Full:
+        # Backpressure: leave the file pending until the workers catch up.
+        with self.counters.lock:
+          self.counters.deferred += 1
+        break
+      with self.counters.lock:
+        self.counters.queued += 1
+      directory, name = os.path.split(path)
+      self.done.setdefault(directory, set()).add(name)
+      del self.pending[path]
+
+
+  """ Helper to list new files in the directories which have changed. """
+  def _scan(self):
+    found = set()
+    stack = [self.directory]
+    stack.extend(d for d in self.directories if d != self.directory)
+    while stack:
+      directory = stack.pop()
+      try:
+        mtime = os.stat(directory).st_mtime
+      except OSError:
+        self.directories.pop(directory, None)
+        self.done.pop(directory, None)
+        continue
+      if self.directories.get(directory) == mtime:
+        continue
+      self.directories[directory] = mtime
+      now = time.time()
+      names = os.listdir(directory)
+      # Forget queued files which have since been removed.
+      done = self.done.get(directory, set()) & set(names)
+      if done:
+        self.done[directory] = done
+      else:
+        self.done.pop(directory, None)
+      for name in names:
+        path = os.path.join(directory, name)
+        if name in done or path in self.pending:
+          continue
+        if os.path.isdir(path):
+          if path not in self.directories:
+            stack.append(path)
+          continue
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        self.pending[path] = [st.st_size, st.st_mtime, 0, now]
+        found.add(path)
+    return found
+
+
+  """ Helper thread which polls until stopped. """
+  def _poll(self):
+    while not self.stopping.is_set():
+      self.poll()
+      self.stopping.wait(self.poll_interval)
+
+
+  """ Helper thread which processes queued files with its own reader. """
+  def _work(self):
+    with dicom.Reader() as reader:
+      while not (self.stopping.is_set() and self.queue.empty()):
+        try:
+          path, seen = self.queue.get(timeout=0.1)
+        except Queue.Empty:
+          continue
+        error = None
+        try:
+          self.handler(path, reader)
+        except Exception as e:
+          error = e
+          if self.on_error is not None:
+            try:
+              self.on_error(path, e)
+            except Exception:
+              pass
+        self.counters.finished(path, time.time() - seen, error)
+        self.queue.task_done()
+
+
+
+# Example usage for converting every image dropped into a directory.
+if __name__ == "__main__":
+  drop_directory, out_directory = sys.argv[1], sys.argv[2]
+
+  def handler(path, reader):
+    name = os.path.relpath(path, drop_directory).replace(os.sep, "_")
+    img = dicom.ImageFile(path, os.path.join(out_directory, name + ".bmp"),
+                          reader)
+    img.read()
+
+  service = IngestService(drop_directory, handler)
+  service.start()
+  try:
+    while True:
+      time.sleep(10)
+      print service.stats()
+      sys.stdout.flush()
+  except KeyboardInterrupt:
+    service.stop()
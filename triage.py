@@ -0,0 +1,179 @@
+import os
+import Queue
+import struct
+import sys
+import threading
+from collections import namedtuple
+
+import dicom
+
+
+
+""" Kinds of file told apart by triage. """
+PART10 = "part10"
+DICOMDIR = "dicomdir"
+NO_PREAMBLE = "no-preamble"
+TRUNCATED = "truncated"
+NOT_DICOM = "not-dicom"
+EMPTY = "empty"
+UNREADABLE = "unreadable"
+
+
+""" Media Storage SOP Class UID of a DICOMDIR. """
+DICOMDIR_SOP_CLASS = "1.2.840.10008.1.3.10"
+
+
+""" Transfer Syntax UIDs which change how the dataset is walked. """
+IMPLICIT_LITTLE_ENDIAN = "1.2.840.10008.1.2"
+EXPLICIT_BIG_ENDIAN = "1.2.840.10008.1.2.2"
+DEFLATED_LITTLE_ENDIAN = "1.2.840.10008.1.2.1.99"
+
+
+""" The classification of one path. """
+TriageResult = namedtuple("TriageResult", ["path", "kind", "size", "detail"])
+
+
+
+""" Helper to get bytes from the sniffed data, or from the file past it. """
+def _bytes(fin, data, pos, n):
+  if pos + n <= len(data):
+    return data[pos:pos + n]
+  fin.seek(pos)
+  return fin.read(n)
+
+
+""" Helper to classify a Part-10 file by walking its top level elements. """
+def _sniffPart10(path, fin, data, size):
+  # Only element headers are read, seeking past the values, up to the end of
+  # the file or the first element of undefined length.
+  kind = PART10
+  syntax = None
+  previous = None
+  pos = 132
+  while pos < size:
+    header = _bytes(fin, data, pos, 12)
+    if len(header) < 8:
+      return TriageResult(path, TRUNCATED, size,
+                          "ends inside an element header at %d" % pos)
+    tag = struct.unpack_from("<HH", header)
+    if tag[0] != 0x0002:
+      if previous is None:
+        return TriageResult(path, NOT_DICOM, size, "no file meta information")
+      if syntax == DEFLATED_LITTLE_ENDIAN:
+        # The rest of the dataset is compressed.
+        break
+      if syntax == EXPLICIT_BIG_ENDIAN:
+        tag = struct.unpack_from(">HH", header)
+
+    order = ">" if tag[0] != 0x0002 and syntax == EXPLICIT_BIG_ENDIAN else "<"
+    if tag[0] != 0x0002 and syntax == IMPLICIT_LITTLE_ENDIAN:
+      length = struct.unpack_from("<I", header, 4)[0]
+      pos += 8
+    else:
+      vr = header[4:6]
+      if not (vr.isalpha() and vr.isupper()):
+        return TriageResult(path, NOT_DICOM, size,
+                            "invalid VR at %d" % pos)
+      if dicom.File.VR_LENGTH[vr] == 4:
+        if len(header) < 12:
+          return TriageResult(path, TRUNCATED, size,
+                              "ends inside an element header at %d" % pos)
+        length = struct.unpack_from(order + "I", header, 8)[0]
+        pos += 12
+      else:
+        length = struct.unpack_from(order + "H", header, 6)[0]
+        pos += 8
+
+    if length == 0xffffffff:
+      # Undefined lengths can not be skipped without parsing the contents.
+      break
+    if pos + length > size:
+      return TriageResult(path, TRUNCATED, size,
+                          "element %04x,%04x ends past the end" % tag)
+    if tag == (0x0002, 0x0002):
+      uid = _bytes(fin, data, pos, length).rstrip(b"\x00 ")
+      if uid == DICOMDIR_SOP_CLASS:
+        kind = DICOMDIR
+    elif tag == (0x0002, 0x0010):
+      syntax = _bytes(fin, data, pos, length).rstrip(b"\x00 ")
+    previous = tag
+    pos += length
+  return TriageResult(path, kind, size, "")
+
+
+""" Classify a file by reading its first bytes and its element headers. """
+def sniff(path, sniff_size=512):
+  try:
+    fin = open(path, "rb")
+    try:
+      size = os.fstat(fin.fileno()).st_size
+      data = fin.read(sniff_size)
+      if size == 0:
+        return TriageResult(path, EMPTY, size, "")
+      if data[128:132] == b"DICM":
+        return _sniffPart10(path, fin, data, size)
+    finally:
+      fin.close()
+  except (IOError, OSError) as e:
+    return TriageResult(path, UNREADABLE, None, str(e))
+
+  if len(data) < 132:
+    # A partial upload of a file with a preamble.
+    if data[:128].strip(b"\x00") == b"" and b"DICM".startswith(data[128:]):
+      return TriageResult(path, TRUNCATED, size, "ends inside the preamble")
+
+  if len(data) >= 8:
+    group = struct.unpack_from("<H", data)[0]
+    if group in (0x0002, 0x0008):
+      vr = data[4:6]
+      if vr.isalpha() and vr.isupper():
+        return TriageResult(path, NO_PREAMBLE, size, "explicit VR")
+      length = struct.unpack_from("<I", data, 4)[0]
+      if 8 + length <= size:
+        return TriageResult(path, NO_PREAMBLE, size, "implicit VR")
+  return TriageResult(path, NOT_DICOM, size, "")
+
+
+""" Classify many paths on a pool of threads, grouping results by kind. """
+def triage(paths, threads=16, sniff_size=512):
+  paths = list(paths)
+  results = [None] * len(paths)
+  work = Queue.Queue()
+  for i, path in enumerate(paths):
+    work.put((i, path))
+
+  def worker():
+    while True:
+      try:
+        i, path = work.get_nowait()
+      except Queue.Empty:
+        return
+      results[i] = sniff(path, sniff_size)
+
+  pool = [threading.Thread(target=worker)
+          for i in range(min(threads, len(paths)))]
+  for t in pool:
+    t.start()
+  for t in pool:
+    t.join()
+
+  report = dict((kind, []) for kind in (PART10, DICOMDIR, NO_PREAMBLE,
+                                        TRUNCATED, NOT_DICOM, EMPTY,
+                                        UNREADABLE))
+  for result in results:
+    report[result.kind].append(result)
+  return report
+
+
+
+# Example usage for triaging every file under a directory.
+if __name__ == "__main__":
+  paths = []
+  for root, directories, filenames in os.walk(sys.argv[1]):
+    paths.extend(os.path.join(root, f) for f in filenames)
+  report = triage(paths)
+  for kind in sorted(report):
+    print kind, len(report[kind])
+    for result in report[kind]:
+      if kind != PART10:
+        print "  " + result.path, result.detail